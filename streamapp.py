@@ -1,21 +1,20 @@
 #!/usr/bin/env python3
 """
-streamlit_app.py – Flatten a PDF into a picture‑only PDF (in memory).
+streamapp.py – Flatten a PDF into a picture‑only PDF (in memory).
 
 Const controls: BASE_FONT_PX, TITLE_FONT_PX, EXPANDER_FONT_PX, FOOTER_FONT_PX
 """
 
-import io, gc, logging, os, shutil, sys
+import gc, hashlib, logging, math, os, queue, struct, sys, threading, time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Callable, Optional
+from typing import Callable, Deque, Dict, List, Optional
 
 import img2pdf
 import streamlit as st
-from pdf2image import (
-    convert_from_bytes,
-    pdfinfo_from_bytes,
-    exceptions as pdf2image_exc,
-)
+import pypdfium2 as pdfium
+import simplejpeg
 
 # ── EASY FONT CONTROLS ─────────────────────────────────────
 BASE_FONT_PX     = 26
@@ -23,96 +22,382 @@ TITLE_FONT_PX    = 48
 EXPANDER_FONT_PX = 20
 FOOTER_FONT_PX   = 18
 
-# ── Poppler & limits ───────────────────────────────────────
-PDFINFO_DIR   = os.path.dirname(shutil.which("pdfinfo") or "")
-POPPLER_KW    = {"poppler_path": PDFINFO_DIR} if PDFINFO_DIR else {}
+# ── Limits ─────────────────────────────────────────────────
 MAX_FILE_SIZE = 25_000_000  # 25 MB
+PAGE_CACHE_BYTES = 8_000_000  # encoded page bytes kept per page cache
+OUTPUT_CACHE_MAX = 4        # flattened PDFs kept per process, across sessions
+RENDER_AHEAD  = 2           # rendered pages buffered ahead of the encoders
+ENCODE_THREADS = 8          # max pages JPEG-encoded in parallel
+MAX_INFLIGHT_BYTES = 400_000_000  # rendered bitmaps alive at once, per PDF
+MAX_EDGE_PX   = 6600        # long-edge cap; 11 in at the 600 DPI slider max
+PROGRESS_INTERVAL = 0.05    # min seconds between progress-bar updates
+MAX_TOTAL_PIXELS = 5_000_000_000  # rendered pixels allowed per PDF
+
+# ── JPEG encoding ──────────────────────────────────────────
+DEFAULT_QUALITY = 85
+JPEG_ENCODE_KW  = {"fastdct": True, "colorsubsampling": "420"}  # simplejpeg
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
+# pdfium is not thread-safe, even across documents; every call goes through this
+_PDFIUM_LOCK = threading.Lock()
+
+
+def _available_cpus() -> int:
+    """CPUs this process may use, honouring affinity and a cgroup v2 CPU quota."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def _page_dpi(dpi: int, width: float, height: float) -> int:
+    """DPI to render a width x height (points) page at, honouring MAX_EDGE_PX."""
+    return max(1, min(dpi, int(72 * MAX_EDGE_PX / max(width, height))))
+
+
+def estimate_pixels(pdf_bytes: bytes, dpi: int) -> int:
+    """Total pixels flattening *pdf_bytes* at *dpi* would render.
+
+    Reads page sizes only, without loading or rendering any page. Returns 0
+    if pdfium cannot open the file, leaving flattening to report the error.
+    """
+    with _PDFIUM_LOCK:
+        try:
+            doc = pdfium.PdfDocument(pdf_bytes)
+        except pdfium.PdfiumError:
+            return 0
+        try:
+            total = 0
+            for page_no in range(len(doc)):
+                width, height = doc.get_page_size(page_no)
+                scale = _page_dpi(dpi, width, height) / 72
+                total += math.ceil(width * scale) * math.ceil(height * scale)
+            return total
+        finally:
+            doc.close()
+
+
+def _pooled_bitmap_maker(pool: Dict[tuple, list]) -> Callable:
+    """Return a PdfPage.render bitmap_maker that reuses buffers from *pool*.
+
+    Buffers are keyed by (width, height, format); the consumer hands them
+    back with _recycle() once a page is encoded.
+    """
+
+    def make(width, height, format, rev_byteorder=False):
+        free = pool.get((width, height, format))
+        return pdfium.PdfBitmap.new_native(
+            width, height, format, rev_byteorder, buffer=free.pop() if free else None
+        )
+
+    return make
+
+
+def _recycle(pool: Dict[tuple, list], bitmap: pdfium.PdfBitmap) -> None:
+    """Return *bitmap*'s buffer to *pool*, keeping free buffers of one size only.
+
+    A page of another size drops the free list, so a PDF whose pages all
+    differ in size holds no more than the pages in flight.
+    """
+    key = (bitmap.width, bitmap.height, bitmap.format)
+    if key not in pool:
+        pool.clear()
+    pool.setdefault(key, []).append(bitmap.buffer)
+
+
+def _render_worker(
+    pdf_bytes: bytes,
+    dpi: int,
+    hash_pages: bool,
+    pool: Dict[tuple, list],
+    out: "queue.Queue",
+    stop: threading.Event,
+) -> None:
+    """Render every page onto *out*, keeping this PDF's pdfium calls on one thread.
+
+    Puts the page count first, then one (bitmap, page_dpi, digest) per page,
+    then None. Any exception is put on the queue for the consumer to raise.
+    Oversized pages get a lower page_dpi so their long edge stays within
+    MAX_EDGE_PX.
+    """
+    try:
+        with _PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(pdf_bytes)
+        try:
+            with _PDFIUM_LOCK:
+                doc.init_forms()  # so filled form fields are drawn into the page
+                page_count = len(doc)
+            out.put(page_count)
+            bitmap_maker = _pooled_bitmap_maker(pool)
+            for page_no in range(page_count):
+                if stop.is_set():
+                    return
+                with _PDFIUM_LOCK:
+                    page = doc[page_no]
+                    page_dpi = _page_dpi(dpi, *page.get_size())
+                    bitmap = page.render(
+                        scale=page_dpi / 72, bitmap_maker=bitmap_maker
+                    )
+                    page.close()
+                # hashlib drops the GIL on large buffers, so this overlaps
+                # with the consumer's JPEG encode; sha256 runs on the CPU's
+                # SHA extensions, about twice as fast as blake2b here
+                digest = (
+                    hashlib.sha256(bitmap.buffer).digest() if hash_pages else None
+                )
+                out.put((bitmap, page_dpi, digest))
+        finally:
+            with _PDFIUM_LOCK:
+                doc.close()
+    except Exception as exc:
+        out.put(exc)
+    else:
+        out.put(None)
+
+
+def _set_jfif_dpi(jpg: bytes, dpi: int) -> bytes:
+    """Stamp *dpi* into the JFIF header so img2pdf keeps the original page size."""
+    # SOI, APP0 marker + length, "JFIF\0", version, then units and X/Y density
+    if jpg[2:4] != b"\xff\xe0" or jpg[6:11] != b"JFIF\0":
+        return jpg
+    return jpg[:13] + struct.pack(">BHH", 1, dpi, dpi) + jpg[18:]
+
+
+def _encode(bitmap: pdfium.PdfBitmap, quality: int) -> bytes:
+    """JPEG-encode a rendered page; simplejpeg releases the GIL while it runs."""
+    # pdfium renders BGR by default; simplejpeg reads that buffer as-is
+    return simplejpeg.encode_jpeg(
+        bitmap.to_numpy(),
+        quality=quality,
+        colorspace="BGR",
+        **JPEG_ENCODE_KW,
+    )
+
+
+def _remember_page(page_cache: Dict[tuple, bytes], key: tuple, jpg: bytes) -> None:
+    """Add *jpg* to *page_cache*, evicting oldest entries past PAGE_CACHE_BYTES."""
+    if len(jpg) > PAGE_CACHE_BYTES:
+        return
+    size = sum(map(len, page_cache.values())) + len(jpg)
+    while size > PAGE_CACHE_BYTES:
+        size -= len(page_cache.pop(next(iter(page_cache))))  # oldest first
+    page_cache[key] = jpg
+
+
+def _take(q: "queue.Queue"):
+    """Get the next item from a render queue, re-raising worker errors."""
+    item = q.get()
+    if isinstance(item, Exception):
+        raise item
+    return item
+
 
 def flatten_pdf_in_memory(
     pdf_bytes: bytes,
     dpi: int,
     quality: int,
     progress_cb: Optional[Callable[[float], None]] = None,
+    page_cache: Optional[Dict[tuple, bytes]] = None,
 ) -> bytes:
-    """Render PDF pages in memory and return flattened PDF bytes."""
+    """Render PDF pages in memory with pdfium and return flattened PDF bytes.
+
+    Rendering runs on a worker thread at most RENDER_AHEAD pages ahead of
+    the JPEG encode, which fans out over up to ENCODE_THREADS threads (one
+    per available CPU), so all cores stay busy while pages are still being
+    rendered. Fewer pages are handed to the encoders at once when that
+    keeps the rendered bitmaps, free pooled buffers included, within
+    MAX_INFLIGHT_BYTES; one page always goes through, so a single page
+    larger than the budget still renders.
+
+    If *page_cache* is given, pages whose rendered pixels were already
+    encoded at this quality (blank pages, repeated letterheads, a re-upload
+    of an edited file) reuse the cached JPEG instead of encoding again.
+    A repeat of a page that is still being encoded waits for that encode.
+    Hashing a page costs most of what encoding it does, on the render
+    thread, so only pass a cache when repeats are likely.
+    """
+    pages: "queue.Queue" = queue.Queue(maxsize=RENDER_AHEAD)
+    stop = threading.Event()
+    # pixel buffers recycled between pages; lives only for this PDF
+    pool: Dict[tuple, list] = {}
+    worker = threading.Thread(
+        target=_render_worker,
+        args=(pdf_bytes, dpi, page_cache is not None, pool, pages, stop),
+        daemon=True,
+    )
+    worker.start()
     try:
-        info = pdfinfo_from_bytes(pdf_bytes, **POPPLER_KW)
-        page_count = int(info.get("Pages", 0))
-    except pdf2image_exc.PDFInfoNotInstalledError:
-        st.error(
-            "Poppler not found. Install poppler‑utils and be sure 'pdfinfo' is in PATH."
-        )
-        raise
-
-    buffers: List[io.BytesIO] = []
-    for page_no in range(1, page_count + 1):
-        imgs = convert_from_bytes(
-            pdf_bytes,
-            dpi=dpi,
-            first_page=page_no,
-            last_page=page_no,
-            **POPPLER_KW,
-        )
-        img = imgs[0]
-        buf = io.BytesIO()
-        img.convert("RGB").save(buf, "JPEG", quality=quality)
-        buf.seek(0)
-        buffers.append(buf)
-        del img, imgs
-        gc.collect()
+        page_count = _take(pages)
+        progress_step = max(1, page_count // 100)
+
+        jpegs: List[bytes] = []
+        # pages handed to the encoders, oldest first, so output stays in order
+        in_flight: Deque[tuple] = deque()
+        # encodes not yet in page_cache, so close repeats share one encode
+        pending: Dict[tuple, Future] = {}
+
+        def finish_oldest() -> None:
+            bitmap, page_dpi, key, cached, job = in_flight.popleft()
+            jpg = cached if job is None else job.result()
+            if job is not None and pending.get(key) is job:
+                del pending[key]
+                _remember_page(page_cache, key, jpg)
+            jpegs.append(_set_jfif_dpi(jpg, page_dpi))
+            _recycle(pool, bitmap)
+
+            # update progress if callback supplied, at most ~100 times per PDF
+            done = len(jpegs)
+            if progress_cb and (done == page_count or done % progress_step == 0):
+                progress_cb(done / page_count)
+
+        threads = min(ENCODE_THREADS, _available_cpus())
+        with ThreadPoolExecutor(max_workers=threads) as encoders:
+            for _ in range(page_count):
+                bitmap, page_dpi, digest = _take(pages)
+                # alive at once: free pooled buffers, the encoders' window,
+                # this page, RENDER_AHEAD queued and one rendering
+                pooled = sum(len(buf) for bufs in pool.values() for buf in bufs)
+                fits = (MAX_INFLIGHT_BYTES - pooled) // (bitmap.stride * bitmap.height)
+                window = max(1, min(threads, fits - RENDER_AHEAD - 2))
+                while len(in_flight) >= window:
+                    finish_oldest()
+                key = (bitmap.width, bitmap.height, quality, digest)
+                cached = page_cache.get(key) if page_cache is not None else None
+                job = pending.get(key) if cached is None else None
+                if cached is None and job is None:
+                    job = encoders.submit(_encode, bitmap, quality)
+                    if page_cache is not None:
+                        pending[key] = job
+                in_flight.append((bitmap, page_dpi, key, cached, job))
+                del bitmap
+            while in_flight:
+                finish_oldest()
+    finally:
+        # unblock the worker if we bailed out early, then wait for it
+        stop.set()
+        while worker.is_alive():
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        gc.collect()  # once per PDF; bitmaps are freed by refcount as we go
+
+    # img2pdf's own writer streams our JPEG bytes straight out; the default
+    # pikepdf engine copies every page into qpdf first and then linearises
+    return img2pdf.convert(jpegs, engine=img2pdf.Engine.internal)
+
+
+def _throttled(cb: Callable[[float], None]) -> Callable[[float], None]:
+    """Wrap a progress callback to fire at most every PROGRESS_INTERVAL s (and at 1.0)."""
+    last = [0.0]
+
+    def _inner(frac: float) -> None:
+        now = time.monotonic()
+        if frac >= 1.0 or now - last[0] >= PROGRESS_INTERVAL:
+            last[0] = now
+            cb(frac)
+
+    return _inner
+
 
-        # update progress if callback supplied
-        if progress_cb:
-            progress_cb(page_no / page_count)
+# cache_resource hands back this dict itself, so a hit returns the stored
+# bytes object; cache_data would pickle the PDF and unpickle a copy per hit
+@st.cache_resource
+def _output_cache() -> "OrderedDict[tuple, bytes]":
+    """Flattened PDFs by (upload digest, dpi, quality), shared by all sessions."""
+    return OrderedDict()
 
-    return img2pdf.convert(buffers)
+
+_OUTPUT_CACHE_LOCK = threading.Lock()
+
+
+def _flatten_cached(
+    pdf_bytes: bytes,
+    dpi: int,
+    quality: int,
+    progress_cb: Optional[Callable[[float], None]] = None,
+    page_cache: Optional[Dict[tuple, bytes]] = None,
+) -> bytes:
+    """flatten_pdf_in_memory, memoised on (file content, dpi, quality).
+
+    Not an st.cache_* function: Streamlit records the progress-bar calls made
+    inside those and replays them on a hit, which fails for a bar created
+    outside. Only a miss runs the flatten, so only a miss reports progress.
+    """
+    key = (hashlib.blake2b(pdf_bytes, digest_size=16).digest(), dpi, quality)
+    cache = _output_cache()
+    with _OUTPUT_CACHE_LOCK:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    flattened = flatten_pdf_in_memory(
+        pdf_bytes,
+        dpi,
+        quality,
+        progress_cb=progress_cb,
+        page_cache=page_cache,
+    )
+    with _OUTPUT_CACHE_LOCK:
+        cache[key] = flattened
+        while len(cache) > OUTPUT_CACHE_MAX:
+            cache.popitem(last=False)  # least recently used
+    return flattened
+
+
+@st.cache_resource
+def _css() -> str:
+    """Global stylesheet, formatted once per process rather than on every rerun."""
+    return f"""
+    <style>
+    :root {{
+        --font-base:{BASE_FONT_PX}px;
+        --font-title:{TITLE_FONT_PX}px;
+        --font-expander:{EXPANDER_FONT_PX}px;
+        --font-footer:{FOOTER_FONT_PX}px;
+    }}
+    html,body{{font-family:'Inter',sans-serif;}}
+    .block-container *{{font-size:var(--font-base)!important;}}
+    .block-container h1{{font-size:var(--font-title)!important;margin-bottom:.5em;}}
+    .stFileUploader *{{font-size:var(--font-base)!important;}}
+
+    div[data-testid="stExpander"]>div[role="button"]{{
+        font-size:var(--font-expander)!important;
+        background:transparent!important;
+    }}
+    div[data-testid="stExpander"] *, .stSlider label{{
+        font-size:var(--font-expander)!important;
+    }}
+    /* numeric values – smaller and lifted higher */
+    .stSlider span {{
+    font-size:calc(var(--font-expander)*0.8)!important;
+    position:relative; top:-14px;
+    }}
+    /* numeric value on slider thumb */
+    .stSlider [class*="ThumbValue"]{{
+    font-size:calc(var(--font-expander)*0.8) !important;
+    transform:translateY(-12px) !important;  /* lift off the track */
+    }}
+    .stProgress>div>div{{height:16px;}}
+    button[kind="primary"]{{padding:.6rem 1.5rem;font-size:1.1rem;}}
+    footer{{visibility:hidden;}}
+    </style>
+    """
 
 
 def main():
     st.set_page_config(page_title="PDF Flattener", page_icon="📄", layout="centered")
 
     # Inject global CSS
-    st.markdown(
-        f"""
-        <style>
-        :root {{
-            --font-base:{BASE_FONT_PX}px;
-            --font-title:{TITLE_FONT_PX}px;
-            --font-expander:{EXPANDER_FONT_PX}px;
-            --font-footer:{FOOTER_FONT_PX}px;
-        }}
-        html,body{{font-family:'Inter',sans-serif;}}
-        .block-container *{{font-size:var(--font-base)!important;}}
-        .block-container h1{{font-size:var(--font-title)!important;margin-bottom:.5em;}}
-        .stFileUploader *{{font-size:var(--font-base)!important;}}
-
-        div[data-testid="stExpander"]>div[role="button"]{{
-            font-size:var(--font-expander)!important;
-            background:transparent!important;
-        }}
-        div[data-testid="stExpander"] *, .stSlider label{{
-            font-size:var(--font-expander)!important;
-        }}
-        /* numeric values – smaller and lifted higher */
-        .stSlider span {{
-        font-size:calc(var(--font-expander)*0.8)!important;
-        position:relative; top:-14px;
-        }}
-        /* numeric value on slider thumb */
-        .stSlider [class*="ThumbValue"]{{
-        font-size:calc(var(--font-expander)*0.8) !important;
-        transform:translateY(-12px) !important;  /* lift off the track */
-        }}
-        .stProgress>div>div{{height:16px;}}
-        button[kind="primary"]{{padding:.6rem 1.5rem;font-size:1.1rem;}}
-        footer{{visibility:hidden;}}
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(_css(), unsafe_allow_html=True)
 
 
 
@@ -137,7 +422,7 @@ def main():
         uploaded = st.file_uploader("Choose a PDF", type=["pdf"])
         with st.expander("Advanced options", expanded=False):
             dpi = st.slider("DPI", 72, 600, 200, step=24)
-            quality = st.slider("JPEG quality", 50, 100, 90, step=5)
+            quality = st.slider("JPEG quality", 50, 100, DEFAULT_QUALITY, step=5)
         submit = st.form_submit_button("Flatten PDF", use_container_width=True)
 
     # ── AFTER SUBMIT ────────────────────────────────────────
@@ -146,6 +431,8 @@ def main():
             st.error("Please upload a PDF first.")
         elif uploaded.size > MAX_FILE_SIZE:
             st.error("File too large. Try a smaller PDF or lower DPI.")
+        elif estimate_pixels(uploaded.getvalue(), dpi) > MAX_TOTAL_PIXELS:
+            st.error("Too many pages at this DPI. Lower the DPI or split the PDF.")
         else:
             logging.info("Flattening %s dpi=%s q=%s", uploaded.name, dpi, quality)
 
@@ -153,12 +440,14 @@ def main():
             progress = st.progress(0.0, text="Rasterising pages…")
 
             try:
-                pdf_bytes = uploaded.read()
-                flattened = flatten_pdf_in_memory(
+                # getvalue() hands back the upload's own bytes object (no
+                # copy) and, unlike read(), ignores the stream position
+                pdf_bytes = uploaded.getvalue()
+                flattened = _flatten_cached(
                     pdf_bytes,
                     dpi,
                     quality,
-                    progress_cb=lambda f: progress.progress(f),
+                    progress_cb=_throttled(progress.progress),
                 )
                 progress.empty()  # clear progress bar
 
@@ -171,7 +460,7 @@ def main():
                 )
             except Exception:
                 progress.empty()
-                st.error("Flattening failed – lower DPI or check Poppler install.")
+                st.error("Flattening failed – lower DPI or check the PDF is valid.")
 
     # Footer
     st.markdown(
@@ -0,0 +1,148 @@
+import io
+
+import pypdfium2 as pdfium
+from streamlit.testing.v1 import AppTest
+
+import streamapp
+
+
+def _blank_pdf(pages: int = 0, sizes=()) -> bytes:
+    doc = pdfium.PdfDocument.new()
+    for width, height in [(612, 792)] * pages + list(sizes):  # Letter, in points
+        doc.new_page(width, height)
+    buf = io.BytesIO()
+    doc.save(buf)
+    doc.close()
+    return buf.getvalue()
+
+
+def _resubmit_app():
+    """Flatten one PDF twice, as two submits of the same upload would."""
+    import streamlit as st
+
+    import streamapp
+    from test_streamapp import _blank_pdf
+
+    pdf_bytes = _blank_pdf(3)
+
+    outputs, reports = [], []
+    for _ in range(2):
+        progress = st.progress(0.0)
+        seen = []
+
+        def report(frac, progress=progress, seen=seen):
+            seen.append(frac)
+            progress.progress(frac)
+
+        # an equal but distinct bytes object each time, as a re-upload would be
+        outputs.append(
+            streamapp._flatten_cached(
+                bytes(bytearray(pdf_bytes)), 72, 85, progress_cb=report
+            )
+        )
+        reports.append(seen)
+
+    st.session_state["outputs"] = outputs
+    st.session_state["hit_is_stored_pdf"] = outputs[1] is outputs[0]
+    st.session_state["reports"] = reports
+
+
+def test_flatten_cached_hit_returns_same_pdf_without_reflattening():
+    at = AppTest.from_function(_resubmit_app, default_timeout=30).run()
+
+    assert not at.exception
+    first, second = at.session_state["outputs"]
+    assert second == first
+    assert at.session_state["hit_is_stored_pdf"]  # no per-hit copy
+    first_report, second_report = at.session_state["reports"]
+    assert first_report and first_report[-1] == 1.0
+    assert second_report == []
+
+
+def test_repeated_pages_share_one_encode(monkeypatch):
+    encodes = []
+    encode = streamapp._encode
+    monkeypatch.setattr(
+        streamapp, "_encode", lambda *args: encodes.append(1) or encode(*args)
+    )
+    page_cache = {}
+
+    flattened = streamapp.flatten_pdf_in_memory(
+        _blank_pdf(6), 72, 85, page_cache=page_cache
+    )
+
+    assert len(pdfium.PdfDocument(flattened)) == 6
+    assert len(encodes) == 1
+    assert len(page_cache) == 1
+
+
+def test_no_page_cache_skips_hashing(monkeypatch):
+    hashed = []
+    sha256 = streamapp.hashlib.sha256
+    monkeypatch.setattr(
+        streamapp.hashlib, "sha256", lambda *args: hashed.append(1) or sha256(*args)
+    )
+
+    streamapp.flatten_pdf_in_memory(_blank_pdf(3), 72, 85)
+
+    assert hashed == []
+
+
+def test_output_pages_keep_source_size():
+    # the 2000 x 3000 pt page renders at 158 DPI, not 200, to stay in MAX_EDGE_PX
+    sizes = [(612, 792), (792, 612), (2000, 3000)]
+
+    flattened = streamapp.flatten_pdf_in_memory(_blank_pdf(sizes=sizes), 200, 85)
+
+    out = pdfium.PdfDocument(flattened)
+    for page_no, (width, height) in enumerate(sizes):
+        out_width, out_height = out.get_page_size(page_no)
+        assert abs(out_width - width) < 1 and abs(out_height - height) < 1
+
+
+def test_set_jfif_dpi_leaves_other_jpegs_alone():
+    exif_jpeg = b"\xff\xd8\xff\xe1\x00\x10Exif\x00\x00" + bytes(16)
+
+    assert streamapp._set_jfif_dpi(exif_jpeg, 200) == exif_jpeg
+    assert streamapp._set_jfif_dpi(b"not a jpeg", 200) == b"not a jpeg"
+
+
+def test_bitmap_pool_stays_bounded_for_mixed_page_sizes(monkeypatch):
+    pools = []
+    maker = streamapp._pooled_bitmap_maker
+    monkeypatch.setattr(
+        streamapp,
+        "_pooled_bitmap_maker",
+        lambda pool: pools.append(pool) or maker(pool),
+    )
+    # every page 1 pt wider than the last, so no two bitmaps share a size
+    sizes = [(612 + i, 792) for i in range(20)]
+
+    streamapp.flatten_pdf_in_memory(_blank_pdf(sizes=sizes), 72, 85)
+
+    (pool,) = pools
+    assert len(pool) == 1
+    assert sum(map(len, pool.values())) == 1
+
+
+def test_estimate_pixels_matches_rendered_pixels(monkeypatch):
+    rendered = []
+    encode = streamapp._encode
+    monkeypatch.setattr(
+        streamapp,
+        "_encode",
+        lambda bitmap, quality: rendered.append(bitmap.width * bitmap.height)
+        or encode(bitmap, quality),
+    )
+    # the 2000 x 3000 pt page is clamped by MAX_EDGE_PX at 200 DPI
+    pdf_bytes = _blank_pdf(sizes=[(612, 792), (792, 612), (2000, 3000)])
+
+    streamapp.flatten_pdf_in_memory(pdf_bytes, 200, 85)
+
+    assert len(rendered) == 3
+    assert max(rendered) < 3000 * 2000 * (200 / 72) ** 2
+    assert streamapp.estimate_pixels(pdf_bytes, 200) == sum(rendered)
+
+
+def test_estimate_pixels_is_zero_for_invalid_pdf():
+    assert streamapp.estimate_pixels(b"not a pdf", 200) == 0